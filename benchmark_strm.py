@@ -0,0 +1,235 @@
+"""STRM生成链路基准测试
+
+用合成的 share_iterdir 替身驱动 generate_strm_files / import_strm_files / handle_restore
+以及快照导出/恢复，
+在临时 OUTPUT_ROOT 与数据库上运行，不访问真实的123网盘接口。
+
+用法示例：
+    python benchmark_strm.py --files 100000 --dup-ratio 0.2 --subtitle-ratio 0.1
+    python benchmark_strm.py --files 1000000 --json bench.json
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from types import SimpleNamespace
+
+BENCH_USER_ID = 1
+STAGES = ("generate", "regenerate", "import", "restore", "export", "load")
+
+# ========================= 合成数据 =========================
+def synthetic_share_iterdir(total, dup_ratio, subtitle_ratio, files_per_dir):
+    """构造与 p123.tool.share_iterdir 同签名的生成器，产出 total 个文件"""
+    def iterdir(share_key, share_pwd="", domain=None, max_depth=-1, predicate=None, **kwargs):
+        unique = 0
+        for index in range(total):
+            relpath = f"{share_key}/dir{index // files_per_dir:05d}/file{index:07d}"
+            # 按比例穿插字幕与重复文件，保证结果可复现
+            if subtitle_ratio and int((index + 1) * subtitle_ratio) > int(index * subtitle_ratio):
+                info = {"is_dir": False, "relpath": relpath + ".srt", "uri": f"123://sub{index}.srt"}
+            else:
+                # 重复文件错开半个周期，避免与字幕落在同一位置
+                if unique and dup_ratio and int((index + 1) * dup_ratio + 0.5) > int(index * dup_ratio + 0.5):
+                    key = index % unique
+                else:
+                    key = unique
+                    unique += 1
+                md5 = hashlib.md5(str(key).encode()).hexdigest()
+                uri = f"123://file{key}.mkv|{1_000_000 + key}|{md5}?s3flag{key:08x}"
+                info = {"is_dir": False, "relpath": relpath + ".mkv", "uri": uri}
+            if predicate is None or predicate(info):
+                yield info
+    return iterdir
+
+def fake_subtitle_get(url, **kwargs):
+    """字幕下载替身，直接返回固定内容"""
+    return SimpleNamespace(content=b"1\n00:00:00,000 --> 00:00:01,000\nbenchmark\n", raise_for_status=lambda: None)
+
+# ========================= 统计 =========================
+class SqliteCounter:
+    """包装 sqlite3.connect，统计连接数与执行的SQL语句数"""
+
+    def __init__(self):
+        self.connections = 0
+        self.statements = 0
+        self._connect = sqlite3.connect
+
+    def _trace(self, statement):
+        self.statements += 1
+
+    def connect(self, *args, **kwargs):
+        conn = self._connect(*args, **kwargs)
+        conn.set_trace_callback(self._trace)
+        self.connections += 1
+        return conn
+
+    def reset(self):
+        self.connections = 0
+        self.statements = 0
+
+def peak_rss_mb():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 单位为KB，macOS 为字节
+    return usage / (1024 * 1024) if sys.platform == "darwin" else usage / 1024
+
+def count_strm_files(root):
+    return sum(1 for _, _, files in os.walk(root) for name in files if name.endswith(".strm"))
+
+def remove_strm_files(root):
+    for base, _, files in os.walk(root):
+        for name in files:
+            if name.endswith(".strm"):
+                os.remove(os.path.join(base, name))
+
+# ========================= 主流程 =========================
+def run_benchmark(args, workdir):
+    output_root = os.path.join(workdir, "strm_output")
+    os.makedirs(output_root, exist_ok=True)
+    os.environ.update({
+        "USER_ID": str(BENCH_USER_ID),
+        "OUTPUT_ROOT": output_root,
+        "DB_PATH": os.path.join(workdir, "strm_records.db"),
+        "BASE_URL": "http://127.0.0.1:8123",
+    })
+    import strm_core
+
+    counter = SqliteCounter()
+    sqlite3.connect = counter.connect
+    strm_core.share_iterdir = synthetic_share_iterdir(
+        args.files, args.dup_ratio, args.subtitle_ratio, args.files_per_dir
+    )
+    strm_core.requests.get = fake_subtitle_get
+    strm_core.Config.CRAWL_RATE = args.crawl_rate
+    strm_core.init_db()
+
+    replies = []
+    async def reply_text(text):
+        replies.append(text)
+    update = SimpleNamespace(
+        effective_user=SimpleNamespace(id=BENCH_USER_ID),
+        message=SimpleNamespace(reply_text=reply_text),
+    )
+
+    # 每个阶段为 (准备, 计时执行, 统计数量)，准备与统计不计入耗时
+    def run_generate():
+        report = strm_core.generate_strm_files("www.123pan.com", "bench", "")
+        return {k: v for k, v in report.items() if k != "skipped_ids"}
+
+    def prepare_import():
+        strm_core.clear_database()
+
+    def run_import():
+        return strm_core.import_strm_files()
+
+    def prepare_restore():
+        remove_strm_files(output_root)
+
+    def run_restore():
+        asyncio.run(strm_core.handle_restore(update, None))
+        return {"reply": replies[-1] if replies else ""}
+
+    snapshot_path = os.path.join(workdir, "strm_snapshot.jsonl.gz")
+
+    def run_export():
+        report = strm_core.export_snapshot(snapshot_path)
+        return {**report, "bytes": os.path.getsize(snapshot_path)}
+
+    def prepare_load():
+        strm_core.clear_database()
+        remove_strm_files(output_root)
+
+    def run_load():
+        return strm_core.import_snapshot(snapshot_path)
+
+    runners = {
+        "generate": (None, run_generate, lambda report: args.files),
+        "regenerate": (None, run_generate, lambda report: args.files),  # 第二次全部命中去重
+        "import": (prepare_import, run_import, lambda report: sum(report.values())),
+        "restore": (prepare_restore, run_restore, lambda report: count_strm_files(output_root)),
+        "export": (None, run_export, lambda report: report["exported"]),
+        "load": (prepare_load, run_load, lambda report: report["imported"] + report["updated"] + report["unchanged"]),
+    }
+
+    results = []
+    with open(os.devnull, "w") as devnull:
+        for stage in args.stages:
+            prepare, run, count_items = runners[stage]
+            with redirect_stdout(devnull):
+                if prepare:
+                    prepare()
+                counter.reset()
+                start = time.perf_counter()
+                report = run()
+                elapsed = time.perf_counter() - start
+            items = count_items(report)
+            results.append({
+                "stage": stage,
+                "items": items,
+                "seconds": round(elapsed, 3),
+                "items_per_sec": round(items / elapsed, 1) if elapsed else None,
+                "sqlite_statements": counter.statements,
+                "sqlite_connections": counter.connections,
+                # ru_maxrss 为进程生命周期内的峰值，各阶段数值是截至该阶段结束的累计峰值
+                "cumulative_peak_rss_mb": round(peak_rss_mb(), 1),
+                "report": report,
+            })
+    return results
+
+def print_results(args, results):
+    print(f"文件数: {args.files} | 重复率: {args.dup_ratio} | 字幕比例: {args.subtitle_ratio}")
+    print(f"{'阶段':<12}{'数量':>10}{'耗时(s)':>10}{'文件/秒':>12}{'SQL语句':>12}{'连接数':>10}{'累计峰值RSS(MB)':>16}")
+    for r in results:
+        print(
+            f"{r['stage']:<12}{r['items']:>10}{r['seconds']:>10.2f}{r['items_per_sec'] or 0:>12.1f}"
+            f"{r['sqlite_statements']:>12}{r['sqlite_connections']:>10}{r['cumulative_peak_rss_mb']:>16.1f}"
+        )
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="STRM生成链路基准测试")
+    parser.add_argument("--files", type=int, default=10000, help="合成文件数量（默认10000）")
+    parser.add_argument("--dup-ratio", type=float, default=0.1, help="视频重复比例（0-1）")
+    parser.add_argument("--subtitle-ratio", type=float, default=0.1, help="字幕文件比例（0-1）")
+    parser.add_argument("--files-per-dir", type=int, default=200, help="每个目录的文件数")
+    parser.add_argument("--crawl-rate", type=float, default=0,
+                        help="列表接口初始限速（次/秒，默认0表示不限速）")
+    parser.add_argument("--stages", default=",".join(STAGES),
+                        help=f"要运行的阶段，逗号分隔（可选：{','.join(STAGES)}）")
+    parser.add_argument("--json", dest="json_path", help="将结果以JSON写入指定文件，便于长期跟踪")
+    parser.add_argument("--keep", action="store_true", help="保留临时目录")
+    args = parser.parse_args(argv)
+    args.stages = [s.strip() for s in args.stages.split(",") if s.strip()]
+    if unknown := set(args.stages) - set(STAGES):
+        parser.error(f"未知阶段：{','.join(sorted(unknown))}")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix="strm_bench_")
+    try:
+        results = run_benchmark(args, workdir)
+    finally:
+        if args.keep:
+            print(f"临时目录已保留：{workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_results(args, results)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "files": args.files,
+                "dup_ratio": args.dup_ratio,
+                "subtitle_ratio": args.subtitle_ratio,
+                "results": results,
+            }, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
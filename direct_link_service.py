@@ -5,9 +5,13 @@ import logging
 from datetime import datetime, timedelta, timezone
 import errno
 import sqlite3
-from contextlib import closing
+from contextlib import closing, asynccontextmanager
 from apscheduler.schedulers.background import BackgroundScheduler
-import atexit
+import threading
+import asyncio
+import heapq
+import itertools
+import time
 import os
 
 def get_version():
@@ -47,11 +51,15 @@ client = P123Client(
     password=os.getenv("P123_PASSWORD")
 )
 token_expiry = None
+login_lock = threading.Lock()
+login_ready = threading.Event()  # 登录成功后置位，未置位时仅提供缓存服务
+db_ready = False
 
 DB_DIR = "/app/data"
 DB_PATH = os.path.join(DB_DIR, "cache.db")
 
 def init_db():
+    global db_ready
     os.makedirs(DB_DIR, exist_ok=True)
     with closing(sqlite3.connect(DB_PATH)) as conn:
         c = conn.cursor()
@@ -66,8 +74,7 @@ def init_db():
         )''')
         c.execute('''CREATE INDEX IF NOT EXISTS idx_main ON cache (file_name, size, etag)''')
         conn.commit()
-
-init_db()
+    db_ready = True
 
 def clear_expired_entries():
     with closing(sqlite3.connect(DB_PATH)) as conn:
@@ -84,45 +91,196 @@ def clear_all_cache():
 
 scheduler = BackgroundScheduler()
 scheduler.add_job(clear_all_cache, 'interval', hours=48)
-scheduler.start()
-atexit.register(lambda: scheduler.shutdown())
 
-def login_client():
+def token_is_valid():
+    return token_expiry is not None and datetime.now() < token_expiry.replace(tzinfo=None)
+
+def login_client(stale_token=None):
+    """登录123云盘；传入 stale_token 时，若等锁期间其他线程已换上有效的新Token则不再重复登录"""
     global client, token_expiry
-    try:
-        login_response = client.user_login(
-            {"passport": client.passport, "password": client.password, "remember": True},
-            async_=False
-        )
-        if isinstance(login_response, dict) and login_response.get("code") == 200:
-            token = login_response["data"]["token"]
-            expired_at = login_response["data"].get("expire")
-            token_expiry = datetime.fromisoformat(expired_at) if expired_at else datetime.now() + timedelta(days=30)
-            client.token = token
-            logger.info("123云盘登录成功")
-        else:
-            logger.error(f"登录失败: {login_response}")
-            raise P123OSError(errno.EIO, login_response)
-    except Exception as e:
-        logger.error(f"登录时发生错误: {str(e)}", exc_info=True)
-        raise
+    with login_lock:
+        if stale_token is not None and getattr(client, "token", None) != stale_token and token_is_valid():
+            return
+        try:
+            login_response = client.user_login(
+                {"passport": client.passport, "password": client.password, "remember": True},
+                async_=False
+            )
+            if isinstance(login_response, dict) and login_response.get("code") == 200:
+                token = login_response["data"]["token"]
+                expired_at = login_response["data"].get("expire")
+                token_expiry = datetime.fromisoformat(expired_at) if expired_at else datetime.now() + timedelta(days=30)
+                client.token = token
+                login_ready.set()
+                logger.info("123云盘登录成功")
+            else:
+                logger.error(f"登录失败: {login_response}")
+                raise P123OSError(errno.EIO, login_response)
+        except Exception as e:
+            logger.error(f"登录时发生错误: {str(e)}", exc_info=True)
+            raise
 
 def ensure_token_valid():
-    global token_expiry
-    if token_expiry is None or datetime.now() >= token_expiry.replace(tzinfo=None):
+    stale_token = getattr(client, "token", None)
+    if not token_is_valid():
         logger.info("Token 无效/过期，正在重新登录...")
-        login_client()
+        login_client(stale_token)
+
+LOGIN_RETRY_MAX_INTERVAL = 300  # 后台登录重试最大间隔（秒）
+
+def background_login(stop_event):
+    """后台登录，失败后按指数退避重试，登录完成前仅提供缓存服务"""
+    interval = 5
+    while not stop_event.is_set():
+        try:
+            login_client()
+            return
+        except Exception:
+            logger.warning(f"登录失败，{interval}秒后重试")
+            stop_event.wait(interval)
+            interval = min(interval * 2, LOGIN_RETRY_MAX_INTERVAL)
+
+# ========================= 上游调度 =========================
+# 优先级：数值越小越优先
+PRIORITY_INTERACTIVE = 0  # 正常播放（GET）
+PRIORITY_BACKGROUND = 1   # HEAD/探测/预热/扫库
+
+UPSTREAM_CONCURRENCY = max(1, int(os.getenv("UPSTREAM_CONCURRENCY", "4")))  # 上游最大并发
+UPSTREAM_RESERVED = min(UPSTREAM_CONCURRENCY - 1, max(0, int(os.getenv("UPSTREAM_RESERVED", "1"))))  # 为播放预留的并发
+UPSTREAM_RATE = float(os.getenv("UPSTREAM_RATE", "5"))  # 全局速率（次/秒，<=0 表示不限速）
+UPSTREAM_BURST = max(1, int(os.getenv("UPSTREAM_BURST", "5")))  # 允许的突发次数
+BACKGROUND_USER_AGENTS = tuple(
+    ua.strip().lower()
+    for ua in os.getenv("BACKGROUND_USER_AGENTS", "ffprobe,mediainfo,prewarm,scanner").split(",")
+    if ua.strip()
+)
+
+class UpstreamScheduler:
+    """上游调用调度器：按优先级排队，限制并发数与全局速率"""
+
+    def __init__(self, max_concurrency, reserved, rate, burst):
+        self.max_concurrency = max_concurrency
+        self.background_limit = max_concurrency - reserved  # 后台请求可占用的并发上限
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._active = 0
+        self._active_background = 0
+        self._waiters = []  # (priority, seq, future)
+        self._seq = itertools.count()
+        self._timer = None
+
+    def _take_token(self):
+        """尝试取令牌，成功返回0，否则返回需要等待的秒数"""
+        if self.rate <= 0:
+            return 0
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self.rate
+
+    def _on_timer(self):
+        self._timer = None
+        self._dispatch()
 
-login_client()
+    def _dispatch(self):
+        while self._waiters and self._active < self.max_concurrency:
+            priority, _, fut = self._waiters[0]
+            if fut.done():  # 等待方已取消
+                heapq.heappop(self._waiters)
+                continue
+            if priority >= PRIORITY_BACKGROUND and self._active_background >= self.background_limit:
+                return
+            if (wait := self._take_token()) > 0:
+                if self._timer is None:
+                    self._timer = asyncio.get_running_loop().call_later(wait, self._on_timer)
+                return
+            heapq.heappop(self._waiters)
+            self._active += 1
+            if priority >= PRIORITY_BACKGROUND:
+                self._active_background += 1
+            fut.set_result(None)
 
-app = FastAPI(debug=False)
+    def _release(self, priority):
+        self._active -= 1
+        if priority >= PRIORITY_BACKGROUND:
+            self._active_background -= 1
+        self._dispatch()
+
+    async def run(self, priority, func, *args):
+        """排队等待执行权后在线程池中执行阻塞调用"""
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), fut))
+        self._dispatch()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self._release(priority)
+            raise
+        try:
+            return await asyncio.to_thread(func, *args)
+        finally:
+            self._release(priority)
+
+upstream_scheduler = UpstreamScheduler(UPSTREAM_CONCURRENCY, UPSTREAM_RESERVED, UPSTREAM_RATE, UPSTREAM_BURST)
+
+def classify_request(request: Request):
+    """根据查询参数、请求方法和 User-Agent 判断请求优先级"""
+    hint = request.query_params.get("priority", "").lower()
+    if hint in ("high", "interactive", "play"):
+        return PRIORITY_INTERACTIVE
+    if hint in ("low", "background", "scan", "prewarm"):
+        return PRIORITY_BACKGROUND
+    if request.method == "HEAD":
+        return PRIORITY_BACKGROUND
+    user_agent = request.headers.get("user-agent", "").lower()
+    if any(ua in user_agent for ua in BACKGROUND_USER_AGENTS):
+        return PRIORITY_BACKGROUND
+    return PRIORITY_INTERACTIVE
+
+def fetch_download_url(payload):
+    """调用上游获取直链，Token失效时重新登录后重试一次"""
+    ensure_token_valid()
+    token = getattr(client, "token", None)
+    try:
+        download_resp = check_response(client.download_info(payload))
+    except P123OSError as e:
+        if isinstance(e.response, dict) and e.response.get("code") == 401:
+            logger.warning("检测到Token错误，强制重新登录...")
+            login_client(token)
+            download_resp = check_response(client.download_info(payload))
+        else:
+            raise
+    return download_resp["data"]["DownloadUrl"]
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    init_db()
+    scheduler.start()
+    stop_login = threading.Event()
+    threading.Thread(target=background_login, args=(stop_login,), name="p123-login", daemon=True).start()
+    yield
+    stop_login.set()
+    scheduler.shutdown()
+
+app = FastAPI(debug=False, lifespan=lifespan)
+
+@app.get("/ready")
+async def ready():
+    """就绪检查：数据库已初始化且123云盘已登录时返回200"""
+    status = {"state": db_ready and login_ready.is_set(), "db": db_ready, "login": login_ready.is_set(), "version": VERSION}
+    return JSONResponse(status, 200 if status["state"] else 503)
 
 @app.get("/{uri:path}")
 @app.head("/{uri:path}")
 async def index(request: Request, uri: str):
     try:
         logger.info(f"收到请求: {request.url}")
-        ensure_token_valid()
 
         if uri.count("|") < 2:
             logger.error("URI 格式错误")
@@ -133,9 +291,10 @@ async def index(request: Request, uri: str):
         size = int(parts[1])
         etag = parts[2].split("?")[0]
         
-        # 参数格式兼容处理
+        # 参数格式兼容处理：旧格式为 ?<s3keyflag>，可追加 &priority=... 等参数
         query_string = str(request.url.query)
-        s3_key_flag = query_string if '=' not in query_string and query_string else request.query_params.get("s3keyflag", "")
+        legacy_flag = next((token for token in query_string.split("&") if token and "=" not in token), "")
+        s3_key_flag = legacy_flag or request.query_params.get("s3keyflag", "")
 
         clear_expired_entries()
 
@@ -149,18 +308,12 @@ async def index(request: Request, uri: str):
                 logger.info(f"缓存命中: {file_name}")
                 return RedirectResponse(row[0], 302)
 
-        payload = {"FileName": file_name, "Size": size, "Etag": etag, "S3KeyFlag": s3_key_flag}
-        try:
-            download_resp = check_response(client.download_info(payload))
-        except P123OSError as e:
-            if isinstance(e.response, dict) and e.response.get("code") == 401:
-                logger.warning("检测到Token错误，强制重新登录...")
-                login_client()
-                download_resp = check_response(client.download_info(payload))
-            else:
-                raise
+        if not login_ready.is_set():
+            logger.warning(f"登录未完成，暂无法获取直链: {file_name}")
+            return JSONResponse({"state": False, "message": "服务登录中，暂仅提供缓存"}, 503)
 
-        download_url = download_resp["data"]["DownloadUrl"]
+        payload = {"FileName": file_name, "Size": size, "Etag": etag, "S3KeyFlag": s3_key_flag}
+        download_url = await upstream_scheduler.run(classify_request(request), fetch_download_url, payload)
 
         with closing(sqlite3.connect(DB_PATH)) as conn:
             c = conn.cursor()
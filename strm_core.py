@@ -3,6 +3,12 @@ import re
 import sqlite3
 import requests
 import hashlib
+import time
+import gzip
+import json
+import asyncio
+import threading
+from bisect import bisect_left, bisect_right
 from p123.tool import share_iterdir
 from datetime import datetime
 from colorama import init, Fore, Style
@@ -36,6 +42,16 @@ class Config:
     VIDEO_EXTENSIONS = ('.mp4', '.mkv', '.avi', '.mov', '.flv', '.ts', '.iso', '.rmvb', '.m2ts', '.mp3', '.flac')
     SUBTITLE_EXTENSIONS = ('.srt', '.ass', '.sub', '.ssa', '.vtt') # 支持的字幕扩展名
     MAX_DEPTH = -1 # 目录遍历深度限制（-1表示无限制）
+    ID_REPORT_LIMIT = 1500  # 单个ID列表在消息中的最大字符数（Telegram单条消息上限4096）
+    CRAWL_RATE = float(os.getenv("CRAWL_RATE", "5"))  # 分享列表接口初始速率（次/秒，<=0 表示不限速）
+    CRAWL_RATE_MIN = 0.5  # 限流后的最低速率
+    CRAWL_RATE_MAX = float(os.getenv("CRAWL_RATE_MAX", "20"))  # 接口正常时可提升到的最高速率
+    CRAWL_PAGE_SIZE = 100  # 列表接口每页条数，用于估算列表请求次数
+    CRAWL_MAX_RETRIES = 5  # 单个分享遇到限流时的最大重试次数
+    SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", os.path.dirname(DB_PATH))  # 快照文件目录
+    SNAPSHOT_BLOCK_ROWS = 5000  # 快照中每个数据块的最大行数
+    READY_URL = os.getenv("READY_URL", "http://127.0.0.1:8123/ready")  # 直链服务就绪检查地址（留空则不等待）
+    READY_TIMEOUT = int(os.getenv("READY_TIMEOUT", "60"))  # 等待直链服务就绪的最长时间（秒）
 # ========================= 权限控制装饰器 =========================
 # 权限验证装饰器（静默模式）
 def restricted(func):
@@ -45,6 +61,20 @@ def restricted(func):
             return
         return await func(update, context)
     return wrapped
+
+# 抓取与修改数据库的命令互斥执行，避免去重检查与写入交错、长事务导致 database is locked
+task_lock = asyncio.Lock()
+TASK_BUSY_MSG = "⏳ 有抓取或数据库任务正在进行，请稍后再试"
+
+def exclusive(func):
+    """修改数据库的命令：有任务进行时直接提示，不排队阻塞其他更新"""
+    async def wrapped(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if task_lock.locked():
+            await update.message.reply_text(TASK_BUSY_MSG)
+            return ConversationHandler.END  # 用于 /clear 确认步骤时同时结束会话，普通命令忽略返回值
+        async with task_lock:
+            return await func(update, context)
+    return wrapped
 # ========================= 数据库操作 =========================
 def init_db():
     with sqlite3.connect(Config.DB_PATH) as conn:
@@ -64,6 +94,8 @@ def init_db():
                 conn.execute("ALTER TABLE strm_records ADD COLUMN status INTEGER DEFAULT 1")
             except sqlite3.OperationalError:
                 pass
+        # 去重查询（check_exists、快照导入）按 文件大小+MD5+S3KeyFlag 匹配
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_dedup ON strm_records (file_size, md5, s3_key_flag)")
         conn.commit()
 
 def check_exists(file_size, md5, s3_key_flag):
@@ -90,14 +122,92 @@ def add_record(file_name, file_size, md5, s3_key_flag, strm_path):
                        (file_name, file_size, md5, s3_key_flag, strm_path))
         conn.commit()
 # ========================= 核心功能 =========================
-def delete_records(record_ids):
-    """批量删除记录"""
+class IdRanges:
+    """有序、互不相交的ID区间集合，内存占用与区间数而非ID数成正比"""
+
+    def __init__(self, ranges=()):
+        self._starts = []
+        self._ends = []
+        for start, end in ranges:
+            self.add_range(start, end)
+
+    def add(self, value):
+        self.add_range(value, value)
+
+    def add_range(self, start, end):
+        """加入闭区间 [start, end]，与相邻或重叠的区间合并"""
+        if start > end:
+            start, end = end, start
+        i = bisect_left(self._ends, start - 1)
+        j = bisect_right(self._starts, end + 1)
+        if i < j:
+            start = min(start, self._starts[i])
+            end = max(end, self._ends[j - 1])
+        self._starts[i:j] = [start]
+        self._ends[i:j] = [end]
+
+    def __iter__(self):
+        return zip(self._starts, self._ends)
+
+    def __len__(self):
+        return sum(end - start + 1 for start, end in self)
+
+    def __bool__(self):
+        return bool(self._starts)
+
+    def __sub__(self, other):
+        result = IdRanges()
+        others = list(other)
+        j = 0
+        for start, end in self:
+            while j < len(others) and others[j][1] < start:
+                j += 1
+            k = j
+            while start <= end:
+                if k >= len(others) or others[k][0] > end:
+                    result.add_range(start, end)
+                    break
+                o_start, o_end = others[k]
+                if o_start > start:
+                    result.add_range(start, o_start - 1)
+                start = o_end + 1
+                k += 1
+        return result
+
+    def format(self, limit=None):
+        """格式化为 "1-5 8 10-12"，超过 limit 个字符时截断并注明剩余区间数"""
+        if not self:
+            return "无"
+        parts = []
+        length = 0
+        for index, (start, end) in enumerate(self):
+            part = f"{start}-{end}" if start != end else str(start)
+            if limit is not None and length + len(part) > limit:
+                parts.append(f"…等{len(self._starts) - index}个区间")
+                break
+            parts.append(part)
+            length += len(part) + 1
+        return ' '.join(parts)
+
+def join_limited(parts, limit, sep='\n'):
+    """拼接文本，超过 limit 个字符时截断并注明剩余条数"""
+    result = []
+    length = 0
+    for index, part in enumerate(parts):
+        if length + len(part) > limit:
+            result.append(f"…等{len(parts) - index}项")
+            break
+        result.append(part)
+        length += len(part) + len(sep)
+    return sep.join(result)
+
+def delete_records(id_ranges):
+    """按区间批量删除记录"""
     with sqlite3.connect(Config.DB_PATH) as conn:
         try:
-            placeholders = ','.join(['?'] * len(record_ids))
-            cursor = conn.execute(
-                f"UPDATE strm_records SET status=0 WHERE id IN ({placeholders})",
-                record_ids
+            cursor = conn.executemany(
+                "UPDATE strm_records SET status=0 WHERE id BETWEEN ? AND ?",
+                list(id_ranges)
             )
             conn.commit()
             return cursor.rowcount
@@ -105,34 +215,18 @@ def delete_records(record_ids):
             print(f"数据库错误: {str(e)}")
             return 0
 
-def get_deleted_ids(attempted_ids):
-    """查询实际被删除的有效ID"""
+def get_deleted_ids(id_ranges):
+    """查询区间内实际被删除的有效ID"""
+    deleted = IdRanges()
     with sqlite3.connect(Config.DB_PATH) as conn:
-        placeholders = ','.join(['?'] * len(attempted_ids))
-        cursor = conn.execute(
-            f"SELECT id FROM strm_records WHERE id IN ({placeholders}) AND status=0",
-            attempted_ids
-        )
-        return [row[0] for row in cursor.fetchall()]
-
-def format_ids(ids):
-    """格式化ID显示（超过10个用区间表示）"""
-    if len(ids) <= 10:
-        return ', '.join(map(str, sorted(ids)))
-    
-    sorted_ids = sorted(ids)
-    ranges = []
-    start = end = sorted_ids[0]
-    
-    for current_id in sorted_ids[1:]:
-        if current_id == end + 1:
-            end = current_id
-        else:
-            ranges.append(f"{start}-{end}" if start != end else str(start))
-            start = end = current_id
-    ranges.append(f"{start}-{end}" if start != end else str(start))
-    
-    return ' '.join(ranges)
+        for start, end in id_ranges:
+            cursor = conn.execute(
+                "SELECT id FROM strm_records WHERE id BETWEEN ? AND ? AND status=0 ORDER BY id",
+                (start, end)
+            )
+            for (record_id,) in cursor:
+                deleted.add(record_id)
+    return deleted
 
 def clear_database():
     with sqlite3.connect(Config.DB_PATH) as conn:
@@ -145,6 +239,143 @@ def get_all_records():
         cursor = conn.execute("SELECT * FROM strm_records WHERE status=1")
         return cursor.fetchall()
 
+SNAPSHOT_FORMAT = "strm-snapshot"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_COLUMNS = ("name", "file_name", "file_size", "md5", "s3_key_flag")
+
+def is_under_root(path, root):
+    """判断规范化后的路径是否位于 root 目录内"""
+    return os.path.commonpath([root, os.path.normpath(path)]) == root
+
+def export_snapshot(path):
+    """导出有效记录为按目录分块的列式快照（gzip压缩的JSON Lines），跳过不在 OUTPUT_ROOT 内的记录"""
+    counts = {
+        'exported': 0,
+        'outside': 0
+    }
+    output_root = os.path.abspath(Config.OUTPUT_ROOT)
+    tmp_path = path + ".tmp"
+    block = None
+    with sqlite3.connect(Config.DB_PATH) as conn, gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+        header = {
+            "format": SNAPSHOT_FORMAT,
+            "version": SNAPSHOT_VERSION,
+            "created_at": datetime.now().isoformat(timespec='seconds'),
+        }
+        f.write(json.dumps(header) + "\n")
+        cursor = conn.execute('''SELECT file_name, file_size, md5, s3_key_flag, strm_path
+                               FROM strm_records WHERE status=1 ORDER BY strm_path''')
+        for file_name, file_size, md5, s3_key_flag, strm_path in cursor:
+            if not is_under_root(strm_path, output_root):
+                counts['outside'] += 1
+                print(f"{Fore.YELLOW}⚠️ 路径不在输出目录内，未导出：{strm_path}")
+                continue
+            # 路径相对 OUTPUT_ROOT 保存，便于迁移到不同的输出目录
+            directory, name = os.path.split(os.path.relpath(strm_path, output_root))
+            if block is None or block["dir"] != directory or len(block["name"]) >= Config.SNAPSHOT_BLOCK_ROWS:
+                if block:
+                    f.write(json.dumps(block, ensure_ascii=False) + "\n")
+                block = {"dir": directory, **{column: [] for column in SNAPSHOT_COLUMNS}}
+            for column, value in zip(SNAPSHOT_COLUMNS, (name, file_name, file_size, md5, s3_key_flag)):
+                block[column].append(value)
+            counts['exported'] += 1
+        if block:
+            f.write(json.dumps(block, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, path)
+    return counts
+
+def import_snapshot(path, write_files=True):
+    """从快照批量导入记录，并按需写出缺失的STRM文件
+
+    与 check_exists 的去重规则一致：已有相同文件（大小+MD5+S3KeyFlag）的有效记录位于其他路径时跳过该行。
+    每个数据块单独提交，中途出错时已写出的STRM文件与已提交的记录保持一致。
+    """
+    counts = {
+        'imported': 0,
+        'updated': 0,
+        'unchanged': 0,
+        'skipped': 0,
+        'outside': 0,
+        'written': 0,
+        'errors': 0
+    }
+    output_root = os.path.abspath(Config.OUTPUT_ROOT)
+    with gzip.open(path, 'rt', encoding='utf-8') as f, sqlite3.connect(Config.DB_PATH) as conn:
+        header = json.loads(f.readline() or "{}")
+        if header.get("format") != SNAPSHOT_FORMAT or header.get("version") != SNAPSHOT_VERSION:
+            raise ValueError(f"不支持的快照格式：{path}")
+
+        for line in f:
+            block = json.loads(line)
+            directory = os.path.normpath(os.path.join(output_root, block["dir"]))
+            rows = []
+            block_keys = set()
+            block_paths = set()
+            for name, file_name, file_size, md5, s3_key_flag in zip(*(block[c] for c in SNAPSHOT_COLUMNS)):
+                strm_path = os.path.normpath(os.path.join(directory, name))
+                # 拒绝 ".." 或绝对路径等指向 OUTPUT_ROOT 之外的条目
+                if not is_under_root(strm_path, output_root):
+                    counts['outside'] += 1
+                    print(f"{Fore.YELLOW}⚠️ 路径不在输出目录内，已跳过：{strm_path}")
+                    continue
+                key = (file_size, md5, s3_key_flag)
+                existing = conn.execute('''SELECT id FROM strm_records
+                                         WHERE file_size=? AND md5=? AND s3_key_flag=? AND status=1
+                                         AND strm_path!=? LIMIT 1''',
+                                      (file_size, md5, s3_key_flag, strm_path)).fetchone()
+                # 同一块内的重复与库中已有的有效记录都视为重复
+                if existing or key in block_keys or strm_path in block_paths:
+                    counts['skipped'] += 1
+                    continue
+                block_keys.add(key)
+                block_paths.add(strm_path)
+                row = (file_name, file_size, md5, s3_key_flag, strm_path)
+                rows.append(row)
+
+                # 区分新增、更新（重新启用或内容变化）与未变化的记录
+                current = conn.execute('''SELECT file_name, file_size, md5, s3_key_flag, status
+                                        FROM strm_records WHERE strm_path=?''',
+                                     (strm_path,)).fetchone()
+                if current is None:
+                    counts['imported'] += 1
+                elif current == (*row[:4], 1):
+                    counts['unchanged'] += 1
+                    continue
+                else:
+                    counts['updated'] += 1
+                conn.execute('''INSERT INTO strm_records
+                              (file_name, file_size, md5, s3_key_flag, strm_path)
+                              VALUES (?, ?, ?, ?, ?)
+                              ON CONFLICT(strm_path) DO UPDATE SET
+                              status=1, file_name=excluded.file_name, file_size=excluded.file_size,
+                              md5=excluded.md5, s3_key_flag=excluded.s3_key_flag''',
+                           row)
+            conn.commit()
+
+            if not write_files:
+                continue
+            for file_name, file_size, md5, s3_key_flag, strm_path in rows:
+                if os.path.exists(strm_path):
+                    continue
+                try:
+                    os.makedirs(os.path.dirname(strm_path), exist_ok=True)
+                    with open(strm_path, 'w', encoding='utf-8') as strm_file:
+                        strm_file.write(f"{Config.BASE_URL}/{file_name}|{file_size}|{md5}?{s3_key_flag}")
+                    counts['written'] += 1
+                except OSError as e:
+                    counts['errors'] += 1
+                    print(f"{Fore.RED}❌ 写入失败：{strm_path}\n{str(e)}")
+    return counts
+
+def compact_database():
+    """清除已删除（status=0）的记录并执行 VACUUM，返回清除条数与前后文件大小"""
+    size_before = os.path.getsize(Config.DB_PATH)
+    with sqlite3.connect(Config.DB_PATH) as conn:
+        purged = conn.execute("DELETE FROM strm_records WHERE status=0").rowcount
+        conn.commit()
+        conn.execute("VACUUM")
+    return purged, size_before, os.path.getsize(Config.DB_PATH)
+
 def parse_strm_content(content):
     try:
         uri = content.strip()
@@ -227,6 +458,113 @@ def import_strm_files():
     
     return counts
 
+class AdaptiveRateLimiter:
+    """自适应限速器：接口正常时线性提速，遇到限流时成倍降速"""
+
+    def __init__(self, rate, min_rate, max_rate, increase=0.1, decrease=0.5):
+        self.enabled = rate > 0
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max(rate, max_rate)
+        self.increase = increase
+        self.decrease = decrease
+        self._next_time = time.monotonic()
+        self._lock = threading.Lock()  # 同一域名可能有多个抓取线程共用
+
+    def acquire(self):
+        """等待到下一次允许发起请求的时间"""
+        if not self.enabled:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._next_time, now)
+            self._next_time = start + 1 / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+    def on_success(self):
+        if self.enabled:
+            with self._lock:
+                self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_throttle(self):
+        if self.enabled:
+            with self._lock:
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(domain):
+    """按域名获取共享的限速器"""
+    with _rate_limiters_lock:
+        if domain not in _rate_limiters:
+            _rate_limiters[domain] = AdaptiveRateLimiter(Config.CRAWL_RATE, Config.CRAWL_RATE_MIN, Config.CRAWL_RATE_MAX)
+        return _rate_limiters[domain]
+
+THROTTLE_STATUS = 429
+THROTTLE_MESSAGES = ("频繁", "too many requests", "rate limit")
+
+def is_throttle_error(e):
+    """判断异常是否为接口限流：优先看响应中的错误码/HTTP状态码，其次看提示信息"""
+    response = getattr(e, "response", None)
+    if isinstance(response, dict):
+        if response.get("code") == THROTTLE_STATUS:
+            return True
+        message = str(response.get("message", ""))
+    else:
+        if THROTTLE_STATUS in (getattr(response, "status_code", None), getattr(e, "status_code", None)):
+            return True
+        message = str(e)
+    return any(marker in message.lower() for marker in THROTTLE_MESSAGES)
+
+def crawl_share(domain: str, share_key: str, share_pwd: str):
+    """带自适应限速的分享遍历，遇到限流时降速并从中断处继续"""
+    limiter = get_rate_limiter(domain)
+    consumed = 0
+    retries = 0
+    while True:
+        iterator = share_iterdir(share_key, share_pwd, domain=domain,
+                                 max_depth=Config.MAX_DEPTH, predicate=lambda x: not x["is_dir"])
+        position = 0
+        last_dir = None
+        dir_count = 0
+        while True:
+            try:
+                info = next(iterator)
+            except StopIteration:
+                return
+            except Exception as e:
+                if not is_throttle_error(e) or retries >= Config.CRAWL_MAX_RETRIES:
+                    raise
+                retries += 1
+                limiter.on_throttle()
+                wait = min(60, 2 ** retries)
+                rate_hint = f"以 {limiter.rate:.1f} 次/秒" if limiter.enabled else ""
+                print(f"{Fore.YELLOW}🐢 {domain} 触发限流，{wait}秒后{rate_hint}从第 {consumed} 个文件继续")
+                time.sleep(wait)
+                break
+
+            # 进入新目录或翻页时视为完成了一次列表请求
+            directory = os.path.dirname(info["relpath"])
+            if directory != last_dir:
+                last_dir, dir_count = directory, 0
+            page_boundary = dir_count % Config.CRAWL_PAGE_SIZE == 0
+            dir_count += 1
+
+            position += 1
+            replaying = position <= consumed
+            if page_boundary:
+                # 重新遍历已处理过的部分同样限速，但不计入提速
+                if not replaying:
+                    limiter.on_success()
+                    retries = 0  # 有新进展后重新计算重试次数
+                limiter.acquire()
+            if replaying:
+                continue
+            consumed = position
+            yield info
+
 def generate_strm_files(domain: str, share_key: str, share_pwd: str):
     counts = {
         'video': 0, 
@@ -234,13 +572,12 @@ def generate_strm_files(domain: str, share_key: str, share_pwd: str):
         'error': 0, 
         'skipped': 0,
         'invalid': 0,
-        'skipped_ids': []
+        'skipped_ids': IdRanges()
     }
 
     print(f"{Fore.YELLOW}🚀 开始处理 {domain} 的分享：{share_key}")
 
-    for info in share_iterdir(share_key, share_pwd, domain=domain,
-                            max_depth=Config.MAX_DEPTH, predicate=lambda x: not x["is_dir"]):
+    for info in crawl_share(domain, share_key, share_pwd):
         try:
             raw_uri = unquote(info["uri"].split("://", 1)[-1])
             relpath = info["relpath"]
@@ -280,7 +617,7 @@ def generate_strm_files(domain: str, share_key: str, share_pwd: str):
 
                     if existing := check_exists(file_size, md5, s3_key_flag):
                         counts['skipped'] += 1
-                        counts['skipped_ids'].append(existing[0])
+                        counts['skipped_ids'].add(existing[0])
                         print(f"{Fore.CYAN}⏩ 跳过重复文件 [ID:{existing[0]}]: {relpath}")
                         continue
 
@@ -331,76 +668,74 @@ def generate_strm_files(domain: str, share_key: str, share_pwd: str):
 
 # ========================= Telegram处理器 =========================
 
-def format_duplicate_ids(ids):
-    if not ids:
-        return "无"
-    
-    ids = sorted(set(ids))
-    ranges = []
-    start = end = ids[0]
-    
-    for current in ids[1:]:
-        if current == end + 1:
-            end = current
-        else:
-            ranges.append(f"{start}-{end}" if start != end else str(start))
-            start = end = current
-    ranges.append(f"{start}-{end}" if start != end else str(start))
-    
-    merged_ranges = []
-    for r in ranges:
-        if '-' in r:
-            s, e = map(int, r.split('-'))
-            if merged_ranges and '-' in merged_ranges[-1]:
-                last_s, last_e = map(int, merged_ranges[-1].split('-'))
-                if last_e + 1 == s:
-                    merged_ranges[-1] = f"{last_s}-{e}"
-                    continue
-            merged_ranges.append(r)
-        else:
-            merged_ranges.append(r)
-    
-    return ' '.join(merged_ranges) if merged_ranges else "无"
-
 @restricted
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """处理123网盘链接"""
+    """处理123网盘链接，同一条消息中的多个链接合并为一批处理"""
     msg = update.message.text
-    # 匹配分享链接格式
-    pattern = r'(https?://(?:[a-zA-Z0-9-]+\.)*123[a-zA-Z0-9-]*\.[a-z]{2,6}+/s/)([a-zA-Z0-9\-_]+)(?:[\s\S]*?(?:提取码|密码|code)[\s:：=]*(\w{4}))?'   
-    if not (match := re.search(pattern, msg, re.IGNORECASE)):
+    # 匹配分享链接格式（提取码不跨越到下一个链接）
+    pattern = r'(https?://(?:[a-zA-Z0-9-]+\.)*123[a-zA-Z0-9-]*\.[a-z]{2,6}+/s/)([a-zA-Z0-9\-_]+)(?:(?:(?!https?://)[\s\S])*?(?:提取码|密码|code)[\s:：=]*(\w{4}))?'
+    shares = {}
+    for match in re.finditer(pattern, msg, re.IGNORECASE):
+        domain = urlparse(match.group(1)).netloc
+        # 同一链接出现多次时保留带提取码的那次
+        if not shares.get(key := (domain, match.group(2))):
+            shares[key] = match.group(3) or ""
+    if not shares:
         return
-    
-    domain = urlparse(match.group(1)).netloc
-    share_key = match.group(2)
-    share_pwd = match.group(3) or ""
 
-    await update.message.reply_text(f"🔄 开始生成 {share_key} 的STRM...")
+    # 同一时间只运行一个抓取批次，后到的消息排队等待
+    if task_lock.locked():
+        await update.message.reply_text("⏳ 有任务正在进行，已加入队列...")
+    async with task_lock:
+        await generate_share_batch(update, shares)
 
-    try:
-        if not re.match(r'^[a-zA-Z0-9\-_]+$', share_key):
-            raise ValueError(f"无效分享码格式：{share_key}")
-            
-        start_time = datetime.now()
-        report = generate_strm_files(domain, share_key, share_pwd)
-        id_ranges = format_duplicate_ids(report['skipped_ids'])
-        
-        result_msg = (
-            f"✅ 处理完成！\n"
-            f"⏱️ 耗时: {(datetime.now() - start_time).total_seconds():.1f}秒\n"
-            f"🎬 视频: {report['video']} | 📝 字幕: {report['subtitle']}\n"
-            f"⏩ 跳过重复: {report['skipped']} | 重复ID: {id_ranges}"
-        )
-        if report['invalid']:
-            result_msg += f"\n⚠️ 无效记录: {report['invalid']}个"
-        if report['error']:
-            result_msg += f"\n❌ 处理错误: {report['error']}个"
-            
-        await update.message.reply_text(result_msg)
-    except Exception as e:
-        await update.message.reply_text(f"❌ 处理失败：{str(e)}")
+async def generate_share_batch(update: Update, shares: dict):
+    """依次处理一批分享并汇总结果"""
+    if len(shares) == 1:
+        await update.message.reply_text(f"🔄 开始生成 {next(iter(shares))[1]} 的STRM...")
+    else:
+        await update.message.reply_text(f"🔄 开始批量生成 {len(shares)} 个分享的STRM...")
+
+    start_time = datetime.now()
+    total = {'video': 0, 'subtitle': 0, 'skipped': 0, 'invalid': 0, 'error': 0}
+    skipped_ids = IdRanges()
+    failures = []
+    for (domain, share_key), share_pwd in shares.items():
+        try:
+            if not re.match(r'^[a-zA-Z0-9\-_]+$', share_key):
+                raise ValueError(f"无效分享码格式：{share_key}")
+            # 抓取包含限速等待，放到线程中执行以免阻塞其他命令
+            report = await asyncio.to_thread(generate_strm_files, domain, share_key, share_pwd)
+        except Exception as e:
+            failures.append(f"{share_key}: {str(e)}")
+            continue
+        for key in total:
+            total[key] += report[key]
+        for start, end in report['skipped_ids']:
+            skipped_ids.add_range(start, end)
+
+    if len(failures) == len(shares):
+        await update.message.reply_text(f"❌ 处理失败：{join_limited(failures, Config.ID_REPORT_LIMIT, '; ')}")
+        return
+
+    id_ranges = skipped_ids.format(Config.ID_REPORT_LIMIT)
+    result_msg = (
+        f"✅ 处理完成！{f'（{len(shares)} 个分享）' if len(shares) > 1 else ''}\n"
+        f"⏱️ 耗时: {(datetime.now() - start_time).total_seconds():.1f}秒\n"
+        f"🎬 视频: {total['video']} | 📝 字幕: {total['subtitle']}\n"
+        f"⏩ 跳过重复: {total['skipped']} | 重复ID: {id_ranges}"
+    )
+    if total['invalid']:
+        result_msg += f"\n⚠️ 无效记录: {total['invalid']}个"
+    if total['error']:
+        result_msg += f"\n❌ 处理错误: {total['error']}个"
+    if failures:
+        result_msg += "\n❌ 失败分享:\n" + join_limited(failures, Config.ID_REPORT_LIMIT)
+
+    await update.message.reply_text(result_msg)
 
 @restricted
+@exclusive
 async def handle_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """处理删除命令，支持批量ID和区间"""
     if not context.args:
@@ -413,44 +748,45 @@ async def handle_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    raw_ids = []
+    unique_ids = IdRanges()
     for arg in context.args:
         if '-' in arg:
             try:
                 start, end = sorted(map(int, arg.split('-')))
-                raw_ids.extend(range(start, end + 1))
             except:
                 await update.message.reply_text(f"❌ 无效区间格式：{arg}")
                 return
         else:
             try:
-                raw_ids.append(int(arg))
+                start = end = int(arg)
             except:
                 await update.message.reply_text(f"❌ 无效ID格式：{arg}")
                 return
+        if end > 0:
+            unique_ids.add_range(max(start, 1), end)
 
-    unique_ids = list({x for x in raw_ids if x > 0})
     if not unique_ids:
         await update.message.reply_text("⚠️ 未提供有效ID")
         return
 
     try:
+        requested_count = len(unique_ids)
         deleted_count = delete_records(unique_ids)
-        failed_count = len(unique_ids) - deleted_count
+        failed_count = requested_count - deleted_count
         
         result = [
-            f"🗑️ 请求删除：{len(unique_ids)} 个记录",
+            f"🗑️ 请求删除：{requested_count} 个记录",
             f"✅ 成功删除：{deleted_count} 个",
             f"❌ 未找到记录：{failed_count} 个"
         ]
         
+        success_ids = get_deleted_ids(unique_ids) if deleted_count > 0 else IdRanges()
         if deleted_count > 0:
-            success_ids = get_deleted_ids(unique_ids)
-            result.append(f"成功ID：{format_ids(success_ids)}")
+            result.append(f"成功ID：{success_ids.format(Config.ID_REPORT_LIMIT)}")
             
         if failed_count > 0:
-            failed_ids = list(set(unique_ids) - set(success_ids))
-            result.append(f"失败ID：{format_ids(failed_ids)}")
+            failed_ids = unique_ids - success_ids
+            result.append(f"失败ID：{failed_ids.format(Config.ID_REPORT_LIMIT)}")
 
         await update.message.reply_text('\n'.join(result))
         
@@ -466,6 +802,7 @@ async def handle_clear_start(update: Update, context: ContextTypes.DEFAULT_TYPE)
     return CONFIRM_CLEAR
 
 @restricted
+@exclusive
 async def handle_clear_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text
     if text == '确认清空':
@@ -523,6 +860,7 @@ async def handle_restore(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(f"❌ 恢复失败：{str(e)}")
 
 @restricted
+@exclusive
 async def handle_import(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         start_time = datetime.now()
@@ -540,18 +878,113 @@ async def handle_import(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         await update.message.reply_text(f"❌ 导入失败：{str(e)}")
 
+@restricted
+async def handle_export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        start_time = datetime.now()
+        os.makedirs(Config.SNAPSHOT_DIR, exist_ok=True)
+        path = os.path.join(Config.SNAPSHOT_DIR, f"strm_snapshot_{start_time:%Y%m%d_%H%M%S}.jsonl.gz")
+        report = export_snapshot(path)
+
+        result_msg = (
+            f"📤 快照导出完成！\n"
+            f"⏱️ 耗时: {(datetime.now() - start_time).total_seconds():.1f}秒\n"
+            f"📄 记录数: {report['exported']}\n"
+            f"💾 文件: {path} ({os.path.getsize(path) / 1024 / 1024:.2f}MB)"
+        )
+        if report['outside']:
+            result_msg += f"\n⚠️ 不在输出目录内未导出: {report['outside']}个"
+        await update.message.reply_text(result_msg)
+    except Exception as e:
+        await update.message.reply_text(f"❌ 导出失败：{str(e)}")
+
+@restricted
+@exclusive
+async def handle_load(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """从快照恢复记录，未指定文件时使用最新的快照"""
+    try:
+        if context.args:
+            name = context.args[0]
+            # 仅允许 SNAPSHOT_DIR 下的文件名，不接受路径
+            if os.path.basename(name) != name or name in (".", ".."):
+                await update.message.reply_text(f"❌ 无效快照文件名：{name}")
+                return
+            path = os.path.join(Config.SNAPSHOT_DIR, name)
+        else:
+            snapshots = sorted(
+                name for name in os.listdir(Config.SNAPSHOT_DIR)
+                if name.startswith("strm_snapshot_") and name.endswith(".jsonl.gz")
+            ) if os.path.isdir(Config.SNAPSHOT_DIR) else []
+            if not snapshots:
+                await update.message.reply_text("⚠️ 未找到可用的快照文件")
+                return
+            path = os.path.join(Config.SNAPSHOT_DIR, snapshots[-1])
+
+        await update.message.reply_text(f"🔄 开始从快照恢复：{os.path.basename(path)}")
+        start_time = datetime.now()
+        report = import_snapshot(path)
+
+        result_msg = (
+            f"📥 快照恢复完成！\n"
+            f"⏱️ 耗时: {(datetime.now() - start_time).total_seconds():.1f}秒\n"
+            f"🆕 新增记录: {report['imported']}\n"
+            f"🔄 更新记录: {report['updated']}\n"
+            f"⏸️ 未变化: {report['unchanged']}\n"
+            f"⏩ 跳过重复: {report['skipped']}\n"
+            f"📝 写出STRM: {report['written']}\n"
+            f"❌ 写入失败: {report['errors']}"
+        )
+        if report['outside']:
+            result_msg += f"\n⚠️ 路径越界已跳过: {report['outside']}个"
+        await update.message.reply_text(result_msg)
+    except Exception as e:
+        await update.message.reply_text(f"❌ 快照恢复失败：{str(e)}")
+
+@restricted
+@exclusive
+async def handle_compact(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        purged, size_before, size_after = compact_database()
+        result_msg = (
+            f"🧹 数据库整理完成\n"
+            f"🗑️ 清除已删除记录: {purged} 个\n"
+            f"💾 文件大小: {size_before / 1024 / 1024:.2f}MB → {size_after / 1024 / 1024:.2f}MB"
+        )
+        await update.message.reply_text(result_msg)
+    except Exception as e:
+        await update.message.reply_text(f"❌ 整理失败：{str(e)}")
+
 async def post_init(application: Application):
     commands = [
         BotCommand("delete", "删除指定ID的记录"),
         BotCommand("clear", "清空数据库记录"),
         BotCommand("restore", "恢复STRM文件到本地"),
-        BotCommand("import", "导入STRM文件到数据库")
+        BotCommand("import", "导入STRM文件到数据库"),
+        BotCommand("export", "导出STRM库快照"),
+        BotCommand("load", "从快照恢复STRM库"),
+        BotCommand("compact", "清除已删除记录并压缩数据库")
     ]
     await application.bot.set_my_commands(commands)
     print(f"{Fore.CYAN}📱 Telegram菜单已加载")
 
+def wait_for_direct_link():
+    """轮询直链服务就绪接口，超时后继续启动"""
+    if not Config.READY_URL:
+        return
+    deadline = time.monotonic() + Config.READY_TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(Config.READY_URL, timeout=5).status_code == 200:
+                print(f"{Fore.GREEN}🔗 直链服务已就绪")
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(1)
+    print(f"{Fore.YELLOW}⚠️ 等待直链服务就绪超时，继续启动")
+
 # ========================= 主程序入口 =========================
 if __name__ == "__main__":
+    wait_for_direct_link()
     init_db()
     os.makedirs(Config.OUTPUT_ROOT, exist_ok=True)
     
@@ -591,12 +1024,16 @@ if __name__ == "__main__":
     app.add_handler(CommandHandler("delete", handle_delete))
     app.add_handler(CommandHandler("restore", handle_restore))
     app.add_handler(CommandHandler("import", handle_import))
+    app.add_handler(CommandHandler("export", handle_export))
+    app.add_handler(CommandHandler("load", handle_load))
+    app.add_handler(CommandHandler("compact", handle_compact))
     app.add_handler(conv_handler)
     app.add_handler(MessageHandler(
     filters.TEXT & 
     ~filters.COMMAND & 
     filters.Regex(r'https?://(?:[a-zA-Z0-9-]+\.)*123[a-zA-Z0-9-]*\.[a-z]{2,6}'),
-    handle_message
+    handle_message,
+    block=False  # 抓取耗时较长，不阻塞后续命令的处理
 ))
     
     #print(f"{Fore.GREEN}🤖 TG机器人已启动 | 数据库：{Config.DB_PATH} | STRM输出目录：{os.path.abspath(Config.OUTPUT_ROOT)} ")